@@ -0,0 +1,212 @@
+"""
+Calibration hors ligne des seuils par label
+Ajuste un calibrateur (isotonique ou Platt) et un seuil par label sur un echantillon
+annote, puis ecrit une table de correspondance compacte (.npz) lue par les handlers.
+
+Entree: un CSV avec, pour chaque label, la verite terrain `<label>` (0/1)
+et la probabilite brute du modele `<label>_prob`, issue de
+/predict/batch?format=compact&calibrated=false : sans ce parametre, les handlers
+renvoient des probabilites deja calibrees des qu'une table est chargee.
+
+Un label sans assez de positifs dans l'echantillon (--min-positives) ne peut pas
+etre calibre : il recoit une table identite et le seuil de reference, avec un
+avertissement, pour ne pas signaler tous les commentaires.
+
+Le calibrateur et le seuil sont ajustes sur une partie de l'echantillon ; la
+comparaison est affichee sur la partie mise de cote (--holdout, stratifiee par
+label). La comparaison se fait par defaut contre un seuil fixe de 0.5 (RoBERTa,
+multilingual). Pour XGBoost, passer les seuils de production avec --baseline-thresholds
+(le pickle du modele ou un JSON {label: seuil}).
+
+Usage:
+    python calibrate.py sample.csv roberta_calibration.npz --method isotonic --beta 0.5
+    python calibrate.py sample.csv multilingual_calibration.npz --labels toxic
+    python calibrate.py sample.csv xgboost_calibration.npz --baseline-thresholds toxic_classifier.pkl
+"""
+
+import argparse
+import json
+import pickle
+
+import numpy as np
+import pandas as pd
+from sklearn.isotonic import IsotonicRegression
+from sklearn.linear_model import LogisticRegression
+
+LABEL_COLS = ['toxic', 'severe_toxic', 'obscene', 'threat', 'insult', 'identity_hate']
+N_KNOTS = 256
+MIN_POSITIVES = 5
+HOLDOUT = 0.3
+EPS = 1e-6
+
+
+def fit_calibrator(scores: np.ndarray, y: np.ndarray, method: str):
+    """Retourne une fonction probabilite brute -> probabilite calibree"""
+    if method == 'isotonic':
+        iso = IsotonicRegression(y_min=0.0, y_max=1.0, out_of_bounds='clip')
+        iso.fit(scores, y)
+        return iso.predict
+
+    # Platt : regression logistique sur le logit de la probabilite brute
+    def logit(p):
+        p = np.clip(p, EPS, 1 - EPS)
+        return np.log(p / (1 - p)).reshape(-1, 1)
+
+    lr = LogisticRegression(C=1e4)
+    lr.fit(logit(scores), y)
+    return lambda p: lr.predict_proba(logit(p))[:, 1]
+
+
+def best_threshold(scores: np.ndarray, y: np.ndarray, beta: float) -> float:
+    """Seuil maximisant le F-beta, evalue en une passe sur tous les points de coupure"""
+    order = np.argsort(-scores, kind='mergesort')
+    s, t = scores[order], y[order]
+    tp = np.cumsum(t)
+    fp = np.cumsum(1 - t)
+
+    # Ne garder que le dernier point de chaque groupe de scores egaux
+    last = np.r_[s[1:] != s[:-1], True]
+    s, tp, fp = s[last], tp[last], fp[last]
+
+    precision = tp / (tp + fp)
+    recall = tp / max(t.sum(), 1)
+    b2 = beta ** 2
+    fbeta = (1 + b2) * precision * recall / np.maximum(b2 * precision + recall, EPS)
+    return float(s[np.argmax(fbeta)])
+
+
+def build_knots(scores: np.ndarray) -> np.ndarray:
+    """Points de la table : quantiles des scores bruts, de 0 a 1 inclus"""
+    return np.quantile(np.r_[0.0, scores, 1.0], np.linspace(0.0, 1.0, N_KNOTS))
+
+
+def identity_knots(scores: np.ndarray, threshold: float) -> np.ndarray:
+    """Knots d'une table identite, avec le seuil comme point exact :
+    score >= seuil reste detecte, score < seuil ne l'est pas"""
+    knots = build_knots(scores)
+    knots[1 + np.argmin(np.abs(knots[1:-1] - threshold))] = threshold
+    return np.sort(knots)
+
+
+def split_holdout(y: np.ndarray, holdout: float, rng: np.random.Generator):
+    """Indices (ajustement, evaluation), la meme proportion de positifs et de negatifs etant mise de cote"""
+    if holdout <= 0:
+        everything = np.arange(len(y))
+        return everything, everything
+
+    train, test = [], []
+    for cls in (0, 1):
+        idx = rng.permutation(np.flatnonzero(y == cls))
+        n_test = int(round(holdout * len(idx)))
+        test.append(idx[:n_test])
+        train.append(idx[n_test:])
+    return np.sort(np.concatenate(train)), np.sort(np.concatenate(test))
+
+
+def precision_recall(pred: np.ndarray, y: np.ndarray):
+    tp = float((pred & (y == 1)).sum())
+    return tp / max(pred.sum(), 1), tp / max(y.sum(), 1)
+
+
+def load_baseline_thresholds(path: str):
+    """Seuils de production par label : pickle XGBoost (cle 'thresholds') ou JSON {label: seuil}"""
+    if path.endswith('.pkl'):
+        with open(path, 'rb') as f:
+            return pickle.load(f)['thresholds']
+    with open(path) as f:
+        return json.load(f)
+
+
+def calibrate(df: pd.DataFrame, labels, method: str, beta: float, baseline=None,
+              min_positives: int = MIN_POSITIVES, holdout: float = HOLDOUT, seed: int = 0):
+    """Calcule la table (knots, values, thresholds) pour tous les labels.
+    baseline : seuils de production par label, 0.5 pour tous si None.
+    holdout : part de l'echantillon reservee a la comparaison (0 : tout l'echantillon)."""
+    rng = np.random.default_rng(seed)
+    knots = np.empty((len(labels), N_KNOTS))
+    values = np.empty((len(labels), N_KNOTS))
+    thresholds = np.empty(len(labels))
+
+    print(f"Reference: {'seuils de production' if baseline else 'seuil fixe 0.5'}")
+    if holdout > 0:
+        print(f"Evaluation: {holdout:.0%} de l'echantillon mis de cote")
+    else:
+        print("Evaluation: sur l'echantillon d'ajustement")
+    print(f"{'label':<15}{'seuil ref':>10}{'prec ref':>10}{'rec ref':>9}"
+          f"{'seuil cal':>10}{'prec cal':>10}{'rec cal':>9}{'alertes':>14}")
+    for j, label in enumerate(labels):
+        all_scores = df[f'{label}_prob'].to_numpy(dtype=float)
+        all_y = df[label].to_numpy(dtype=int)
+        train, test = split_holdout(all_y, holdout, rng)
+        scores, y = all_scores[train], all_y[train]
+        base_threshold = float(baseline[label]) if baseline else 0.5
+
+        positives = int(y.sum())
+        degenerate = positives < min_positives or positives == len(y)
+        if degenerate:
+            # Une seule classe (ou trop peu de positifs) : rien a calibrer
+            print(f"ATTENTION: {label}: {positives} positifs sur {len(y)}, "
+                  f"table identite et seuil de reference {base_threshold:.3f}")
+            knots[j] = identity_knots(scores, base_threshold)
+            values[j] = knots[j]
+            thresholds[j] = base_threshold
+        else:
+            calibrator = fit_calibrator(scores, y, method)
+            knots[j] = build_knots(scores)
+            values[j] = calibrator(knots[j])
+
+        # Le seuil est choisi sur les probabilites telles que les handlers les verront
+        row = np.searchsorted(knots[j], scores, side='right') - 1
+        calibrated = values[j][row]
+        if not degenerate:
+            thresholds[j] = best_threshold(calibrated, y, beta)
+
+        # Comparaison sur la partie mise de cote
+        scores, y = all_scores[test], all_y[test]
+        calibrated = values[j][np.searchsorted(knots[j], scores, side='right') - 1]
+        base_pred = scores >= base_threshold
+        cal_pred = calibrated >= thresholds[j]
+        p0, r0 = precision_recall(base_pred, y)
+        p1, r1 = precision_recall(cal_pred, y)
+        print(f"{label:<15}{base_threshold:>10.3f}{p0:>10.3f}{r0:>9.3f}"
+              f"{thresholds[j]:>10.3f}{p1:>10.3f}{r1:>9.3f}"
+              f"{int(base_pred.sum()):>7} -> {int(cal_pred.sum()):<5}")
+
+    return knots, values, thresholds
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Calibration des seuils par label")
+    parser.add_argument('sample', help="CSV annote avec les colonnes <label> et <label>_prob")
+    parser.add_argument('output', help="Fichier .npz de sortie")
+    parser.add_argument('--labels', nargs='+', default=LABEL_COLS)
+    parser.add_argument('--method', choices=['isotonic', 'platt'], default='isotonic')
+    parser.add_argument('--beta', type=float, default=1.0,
+                        help="Poids du rappel dans le F-beta (< 1 favorise la precision)")
+    parser.add_argument('--min-positives', type=int, default=MIN_POSITIVES,
+                        help="Positifs minimum pour calibrer un label (sinon table identite)")
+    parser.add_argument('--holdout', type=float, default=HOLDOUT,
+                        help="Part de l'echantillon reservee a la comparaison (0 : aucune)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--baseline-thresholds',
+                        help="Seuils de reference (pickle XGBoost ou JSON {label: seuil}) ; 0.5 par defaut")
+    args = parser.parse_args()
+
+    df = pd.read_csv(args.sample)
+    baseline = load_baseline_thresholds(args.baseline_thresholds) if args.baseline_thresholds else None
+    knots, values, thresholds = calibrate(df, args.labels, args.method, args.beta, baseline,
+                                          args.min_positives, args.holdout, args.seed)
+
+    np.savez_compressed(
+        args.output,
+        labels=np.array(args.labels),
+        knots=knots.astype(np.float32),
+        values=values.astype(np.float32),
+        thresholds=thresholds.astype(np.float32),
+        method=np.array(args.method)
+    )
+    print(f"Table de calibration ecrite: {args.output}")
+
+
+if __name__ == '__main__':
+    main()
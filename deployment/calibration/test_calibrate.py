@@ -0,0 +1,104 @@
+"""
+Tests de calibrate.py : labels sans positifs et application de la table par le handler XGBoost.
+"""
+
+import importlib.util
+import os
+import sys
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pd = pytest.importorskip('pandas')
+pytest.importorskip('sklearn')
+
+CALIBRATION_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, CALIBRATION_DIR)
+from calibrate import LABEL_COLS, calibrate  # noqa: E402
+
+
+def make_sample(n=400, seed=0, empty=('threat',)):
+    """Echantillon synthetique : probabilites brutes correlees aux labels, sauf `empty` sans positifs"""
+    rng = np.random.default_rng(seed)
+    data = {}
+    for label in LABEL_COLS:
+        y = np.zeros(n, dtype=int) if label in empty else (rng.random(n) < 0.2).astype(int)
+        data[label] = y
+        data[f'{label}_prob'] = np.clip(0.35 * y + rng.beta(2, 5, n), 0.0, 1.0)
+    return pd.DataFrame(data)
+
+
+def apply_per_label(knots, values, probs):
+    """Reference : un searchsorted par label"""
+    out = np.empty_like(probs)
+    for j in range(knots.shape[0]):
+        idx = np.searchsorted(knots[j], probs[:, j], side='right') - 1
+        out[:, j] = values[j][idx]
+    return out
+
+
+@pytest.mark.parametrize('method', ['isotonic', 'platt'])
+def test_label_without_positives_gets_identity_and_baseline(method, capsys):
+    df = make_sample()
+    baseline = {label: 0.5 for label in LABEL_COLS}
+    baseline['threat'] = 0.42
+
+    knots, values, thresholds = calibrate(df, LABEL_COLS, method, beta=1.0, baseline=baseline)
+
+    j = LABEL_COLS.index('threat')
+    assert 'ATTENTION: threat' in capsys.readouterr().out
+    assert np.array_equal(values[j], knots[j])
+    assert thresholds[j] == pytest.approx(0.42)
+
+    # La table identite ne change pas les alertes par rapport au seuil de reference
+    scores = df['threat_prob'].to_numpy()
+    calibrated = apply_per_label(knots[j:j + 1], values[j:j + 1], scores[:, None])[:, 0]
+    assert ((calibrated >= thresholds[j]) == (scores >= 0.42)).all()
+
+
+def test_too_few_positives_falls_back_to_baseline():
+    df = make_sample(empty=())
+    df['threat'] = 0
+    df.loc[:2, 'threat'] = 1
+
+    knots, values, thresholds = calibrate(df, LABEL_COLS, 'isotonic', beta=1.0, min_positives=5)
+
+    j = LABEL_COLS.index('threat')
+    assert np.array_equal(values[j], knots[j])
+    assert thresholds[j] == 0.5
+
+
+def test_handler_lookup_matches_per_label_lookup(tmp_path):
+    for dependency in ('fastapi', 'orjson', 'mangum', 'boto3', 'nltk'):
+        pytest.importorskip(dependency)
+    spec = importlib.util.spec_from_file_location(
+        'xgboost_app', os.path.join(CALIBRATION_DIR, '..', 'lambda-xgboost', 'app.py')
+    )
+    xgboost_app = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(xgboost_app)
+
+    knots, values, thresholds = calibrate(make_sample(), LABEL_COLS, 'isotonic', beta=1.0)
+    path = tmp_path / 'xgboost_calibration.npz'
+    np.savez_compressed(path, labels=np.array(LABEL_COLS), knots=knots.astype(np.float32),
+                        values=values.astype(np.float32), thresholds=thresholds.astype(np.float32),
+                        method=np.array('isotonic'))
+    table = np.load(path)
+
+    wrapper = object.__new__(xgboost_app.ToxicClassifierWrapper)
+    wrapper.calibration = xgboost_app.build_lookup(table)
+
+    probs = np.random.default_rng(1).random((500, len(LABEL_COLS)))
+    probs[:3] = np.array([0.0, 1.0, 0.5])[:, None]
+    expected = apply_per_label(table['knots'].astype(np.float64), table['values'], probs)
+    assert np.array_equal(wrapper.calibrate(probs), expected)
+
+
+def test_holdout_is_stratified_and_disjoint():
+    from calibrate import split_holdout
+
+    y = np.r_[np.ones(20, dtype=int), np.zeros(80, dtype=int)]
+    train, test = split_holdout(y, 0.3, np.random.default_rng(0))
+
+    assert len(np.intersect1d(train, test)) == 0
+    assert len(train) + len(test) == len(y)
+    assert y[test].sum() == 6 and len(test) == 30
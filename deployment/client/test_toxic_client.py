@@ -0,0 +1,140 @@
+"""
+Tests du client contre l'application XGBoost servie en memoire (httpx.ASGITransport).
+Le modele est remplace par un classificateur factice : aucun acces S3 ni reseau.
+"""
+
+import asyncio
+import importlib.util
+import os
+import sys
+
+import pytest
+
+httpx = pytest.importorskip('httpx')
+np = pytest.importorskip('numpy')
+for dependency in ('fastapi', 'orjson', 'mangum', 'boto3', 'pandas', 'nltk'):
+    pytest.importorskip(dependency)
+
+CLIENT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, CLIENT_DIR)
+from toxic_client import ToxicClient  # noqa: E402
+
+spec = importlib.util.spec_from_file_location(
+    'xgboost_app', os.path.join(CLIENT_DIR, '..', 'lambda-xgboost', 'app.py')
+)
+xgboost_app = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(xgboost_app)
+
+
+class FakeClassifier:
+    """Remplace ToxicClassifierWrapper : 'stupid' est toxique sur tous les labels"""
+
+    def __init__(self):
+        self.thresholds = {label: 0.5 for label in xgboost_app.LABEL_COLS}
+        self.raw_thresholds = {label: 0.3 for label in xgboost_app.LABEL_COLS}
+        self.calls = []
+
+    def predict_proba_batch(self, texts, calibrated=True):
+        self.calls.append(list(texts))
+        high, low = (0.9, 0.1) if calibrated else (0.8, 0.2)
+        return np.array([[high if 'stupid' in t else low] * len(xgboost_app.LABEL_COLS) for t in texts])
+
+
+class CountingTransport(httpx.AsyncBaseTransport):
+    """Compte les POST et renvoie 503 pour les `failures` premiers"""
+
+    def __init__(self, app, failures=0):
+        self.inner = httpx.ASGITransport(app=app)
+        self.failures = failures
+        self.posts = 0
+
+    async def handle_async_request(self, request):
+        self.posts += 1
+        if self.failures:
+            self.failures -= 1
+            return httpx.Response(503)
+        return await self.inner.handle_async_request(request)
+
+
+@pytest.fixture
+def classifier(monkeypatch):
+    fake = FakeClassifier()
+    monkeypatch.setattr(xgboost_app, 'classifier', fake)
+    return fake
+
+
+def make_client(transport):
+    return ToxicClient(services=['xgboost'], transports={'xgboost': transport}, backoff=0)
+
+
+def test_concurrent_calls_are_coalesced_into_one_batch(classifier):
+    transport = CountingTransport(xgboost_app.app)
+    texts = ['you are stupid', 'thanks a lot', 'nice edit', 'stupid idea', 'hello']
+
+    async def run():
+        async with make_client(transport) as client:
+            return await client.predict_many(texts)
+
+    results = asyncio.run(run())
+
+    assert transport.posts == 1
+    assert classifier.calls == [texts]
+    assert [r['is_toxic'] for r in results] == [True, False, False, True, False]
+    assert results[0]['labels']['insult'] == {'probability': 0.9, 'threshold': 0.5, 'detected': True}
+    assert results[1]['detected_labels'] == []
+
+
+def test_repeated_call_is_served_from_cache(classifier):
+    transport = CountingTransport(xgboost_app.app)
+
+    async def run():
+        async with make_client(transport) as client:
+            first = await client.predict('you are stupid')
+            second = await client.predict('you are stupid')
+            return first, second
+
+    first, second = asyncio.run(run())
+
+    assert transport.posts == 1
+    assert first == second
+
+
+def test_503_is_retried(classifier):
+    transport = CountingTransport(xgboost_app.app, failures=1)
+
+    async def run():
+        async with make_client(transport) as client:
+            return await client.predict('you are stupid')
+
+    result = asyncio.run(run())
+
+    assert transport.posts == 2
+    assert result['is_toxic'] is True
+
+
+def test_raw_scores_are_served_uncalibrated(classifier):
+    async def run():
+        transport = httpx.ASGITransport(app=xgboost_app.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://testserver') as http:
+            raw = await http.post('/predict/batch', params={'format': 'compact', 'calibrated': 'false'},
+                                  json={'comments': ['you are stupid']})
+            verbose = await http.post('/predict/batch', params={'calibrated': 'false'},
+                                      json={'comments': ['you are stupid']})
+            return raw, verbose
+
+    raw, verbose = asyncio.run(run())
+
+    body = raw.json()
+    assert body['calibrated'] is False
+    assert body['probabilities'] == [[0.8] * len(xgboost_app.LABEL_COLS)]
+    assert body['thresholds'] == [0.3] * len(xgboost_app.LABEL_COLS)
+    assert verbose.status_code == 400
+
+
+def test_unknown_service_raises_value_error(classifier):
+    async def run():
+        async with make_client(CountingTransport(xgboost_app.app)) as client:
+            await client.predict('hello', service='bert')
+
+    with pytest.raises(ValueError):
+        asyncio.run(run())
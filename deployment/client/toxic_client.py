@@ -0,0 +1,190 @@
+"""
+Client Python asynchrone pour les trois services de classification
+- pool de connexions HTTP par service (httpx)
+- regroupement automatique des appels unitaires en /predict/batch (dans la limite max_items)
+- appels concurrents vers plusieurs services
+- retries avec backoff exponentiel et jitter
+- cache local LRU des resultats
+
+Usage:
+    async with ToxicClient() as client:
+        result = await client.predict("You are stupid!", service='roberta')
+        results = await client.predict_all("Tu es stupide!")
+
+Tests en memoire (sans reseau) :
+    ToxicClient(transports={'roberta': httpx.ASGITransport(app=roberta_app)})
+
+Les appels regroupes partagent une seule requete HTTP : si elle echoue (apres
+les retries), tous les appels du lot recoivent la meme exception.
+"""
+
+import asyncio
+import random
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import httpx
+
+DEFAULT_BASE_URL = 'https://0hik6heuhc.execute-api.us-east-1.amazonaws.com/prod'
+SERVICE_MAX_ITEMS = {'xgboost': 50, 'roberta': 20, 'multilingual': 20}
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class ToxicClient:
+    """Client asynchrone pour /xgboost, /roberta et /multilingual"""
+
+    def __init__(
+        self,
+        base_url: str = DEFAULT_BASE_URL,
+        services: Sequence[str] = tuple(SERVICE_MAX_ITEMS),
+        max_wait: float = 0.01,
+        max_retries: int = 3,
+        backoff: float = 0.2,
+        cache_size: int = 4096,
+        timeout: float = 30.0,
+        max_connections: int = 10,
+        transports: Optional[Dict[str, httpx.AsyncBaseTransport]] = None,
+    ):
+        self.services = list(services)
+        self.max_wait = max_wait
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[Tuple[str, str], Dict[str, Any]]" = OrderedDict()
+        self._pending: Dict[str, "OrderedDict[str, asyncio.Future]"] = {s: OrderedDict() for s in self.services}
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+        self._tasks = set()
+
+        transports = transports or {}
+        limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        self._clients = {
+            service: httpx.AsyncClient(
+                base_url='http://testserver' if service in transports else f"{base_url.rstrip('/')}/{service}",
+                transport=transports.get(service),
+                limits=limits,
+                timeout=timeout,
+            )
+            for service in self.services
+        }
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def aclose(self):
+        """Envoie les lots en attente puis ferme les connexions"""
+        for service in self.services:
+            self._flush(service)
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        for client in self._clients.values():
+            await client.aclose()
+
+    async def predict(self, text: str, service: str = 'xgboost') -> Dict[str, Any]:
+        """Predit un commentaire ; les appels concurrents sont regroupes en un seul lot"""
+        if service not in self._clients:
+            raise ValueError(f"Service inconnu: {service} (services configures: {', '.join(self.services)})")
+
+        key = (service, text)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        # Un meme texte deja en attente partage le resultat du lot en cours
+        pending = self._pending[service]
+        future = pending.get(text)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = pending[text] = loop.create_future()
+            if len(pending) >= SERVICE_MAX_ITEMS[service]:
+                self._flush(service)
+            elif service not in self._timers:
+                self._timers[service] = loop.call_later(self.max_wait, self._flush, service)
+        return await asyncio.shield(future)
+
+    async def predict_many(self, texts: Sequence[str], service: str = 'xgboost') -> List[Dict[str, Any]]:
+        """Predit une liste de commentaires sur un service"""
+        return list(await asyncio.gather(*(self.predict(t, service) for t in texts)))
+
+    async def predict_all(self, text: str, services: Optional[Sequence[str]] = None) -> Dict[str, Dict[str, Any]]:
+        """Interroge plusieurs services en parallele pour un meme commentaire"""
+        services = list(services or self.services)
+        results = await asyncio.gather(*(self.predict(text, s) for s in services))
+        return dict(zip(services, results))
+
+    def _flush(self, service: str):
+        """Detache le lot en attente et l'envoie en tache de fond"""
+        timer = self._timers.pop(service, None)
+        if timer is not None:
+            timer.cancel()
+
+        pending = self._pending[service]
+        if not pending:
+            return
+        batch = list(pending.items())
+        pending.clear()
+
+        task = asyncio.ensure_future(self._send_batch(service, batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send_batch(self, service: str, batch: List[Tuple[str, asyncio.Future]]):
+        """Envoie un lot ; en cas d'echec, tous les appels du lot recoivent la meme exception"""
+        texts = [text for text, _ in batch]
+        try:
+            body = await self._post(service, texts)
+            results = unpack_compact(body)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (text, future), result in zip(batch, results):
+            self._store(service, text, result)
+            if not future.done():
+                future.set_result(result)
+
+    async def _post(self, service: str, texts: List[str]) -> Dict[str, Any]:
+        """POST /predict/batch au format compact, avec retries et backoff jitter"""
+        client = self._clients[service]
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = await client.post('/predict/batch', params={'format': 'compact'}, json={'comments': texts})
+                if response.status_code not in RETRY_STATUS or attempt == self.max_retries:
+                    response.raise_for_status()
+                    return response.json()
+            except httpx.TransportError:
+                if attempt == self.max_retries:
+                    raise
+            await asyncio.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+
+    def _store(self, service: str, text: str, result: Dict[str, Any]):
+        self._cache[(service, text)] = result
+        self._cache.move_to_end((service, text))
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+
+def unpack_compact(body: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Convertit une reponse compacte en un resultat par commentaire, avec detected par label"""
+    labels = body['labels']
+    # Les seuils (eventuellement calibres) sont envoyes une seule fois par lot
+    thresholds = body['thresholds']
+    results = []
+    for i, probs in enumerate(body['probabilities']):
+        details = {
+            label: {'probability': p, 'threshold': t, 'detected': p >= t}
+            for label, p, t in zip(labels, probs, thresholds)
+        }
+        result = {
+            'is_toxic': body['is_toxic'][i],
+            'labels': details,
+            'detected_labels': [label for label, info in details.items() if info['detected']]
+        }
+        if 'language_detected' in body:
+            result['language_detected'] = body['language_detected'][i]
+        results.append(result)
+    return results
@@ -0,0 +1,191 @@
+"""
+Distillation du modele RoBERTa - entrainement d'un etudiant a 4-6 couches
+L'etudiant est une copie elaguee de roberta_toxic_best.pt (couches reparties
+uniformement, premiere et derniere incluses : 0,2,4,7,9,11 pour 6 couches)
+entrainee sur les logits du professeur. Le checkpoint produit
+se charge tel quel dans lambda-roberta/app.py : il suffit de pointer MODEL_KEY dessus.
+
+Fonctionne sur CPU a petite echelle (--limit) pour valider sans GPU.
+
+Usage:
+    python distill.py roberta_toxic_best.pt train.csv --eval test_labeled.csv --layers 4 6 --limit 2000
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn as nn
+from sklearn.metrics import roc_auc_score
+
+# Reutilise l'architecture et le tokenizer du handler pour garantir la compatibilite
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda-roberta'))
+from app import LABEL_COLS, RobertaToxicClassifier, count_encoder_layers  # noqa: E402
+from transformers import RobertaTokenizer  # noqa: E402
+
+device = torch.device('cpu')
+MAX_LENGTH = 128
+
+
+def select_layers(num_teacher_layers: int, num_layers: int):
+    """Couches du professeur copiees dans l'etudiant, reparties uniformement"""
+    return np.linspace(0, num_teacher_layers - 1, num_layers).round().astype(int).tolist()
+
+
+def build_student(teacher_state: dict, num_layers: int) -> RobertaToxicClassifier:
+    """Initialise l'etudiant avec les embeddings, la tete et un sous-ensemble des couches du professeur"""
+    kept = select_layers(count_encoder_layers(teacher_state), num_layers)
+    prefix = 'roberta.encoder.layer.'
+
+    student_state = {}
+    for key, value in teacher_state.items():
+        if not key.startswith(prefix):
+            student_state[key] = value
+            continue
+        index, rest = key[len(prefix):].split('.', 1)
+        if int(index) in kept:
+            student_state[f'{prefix}{kept.index(int(index))}.{rest}'] = value
+
+    student = RobertaToxicClassifier(num_labels=len(LABEL_COLS), num_layers=num_layers)
+    student.load_state_dict(student_state)
+    return student.to(device)
+
+
+def encode(tokenizer, texts):
+    return tokenizer(texts, padding=True, truncation=True, max_length=MAX_LENGTH, return_tensors='pt')
+
+
+def batches(n: int, batch_size: int):
+    for start in range(0, n, batch_size):
+        yield slice(start, min(start + batch_size, n))
+
+
+def predict_logits(model, tokenizer, texts, batch_size: int) -> torch.Tensor:
+    """Logits du modele sur une liste de textes, par lots"""
+    model.eval()
+    outputs = []
+    with torch.no_grad():
+        for sl in batches(len(texts), batch_size):
+            enc = encode(tokenizer, texts[sl])
+            outputs.append(model(enc['input_ids'], enc['attention_mask']))
+    return torch.cat(outputs)
+
+
+def distill(student, tokenizer, texts, teacher_logits, labels, args):
+    """Entraine l'etudiant : BCE sur les probabilites adoucies du professeur (+ labels si fournis)"""
+    optimizer = torch.optim.AdamW(student.parameters(), lr=args.lr)
+    soft_loss = nn.BCEWithLogitsLoss()
+    hard_loss = nn.BCEWithLogitsLoss()
+    T = args.temperature
+
+    for epoch in range(args.epochs):
+        student.train()
+        order = np.random.permutation(len(texts))
+        total = 0.0
+
+        for sl in batches(len(texts), args.batch_size):
+            idx = order[sl]
+            enc = encode(tokenizer, [texts[i] for i in idx])
+            logits = student(enc['input_ids'], enc['attention_mask'])
+
+            loss = soft_loss(logits / T, torch.sigmoid(teacher_logits[idx] / T)) * T ** 2
+            if labels is not None:
+                loss = (1 - args.alpha) * loss + args.alpha * hard_loss(logits, labels[idx])
+
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            total += loss.item() * len(idx)
+
+        print(f"  epoch {epoch + 1}/{args.epochs} - loss {total / len(texts):.4f}")
+
+    student.eval()
+    return student
+
+
+def mean_auc(model, tokenizer, eval_df: pd.DataFrame, batch_size: int) -> float:
+    """AUC moyenne sur les labels presents dans les deux classes"""
+    probs = torch.sigmoid(predict_logits(model, tokenizer, eval_df['comment_text'].tolist(), batch_size)).numpy()
+    aucs = [roc_auc_score(eval_df[label], probs[:, j])
+            for j, label in enumerate(LABEL_COLS) if eval_df[label].nunique() == 2]
+    return float(np.mean(aucs)) if aucs else float('nan')
+
+
+def latency_ms(model, tokenizer, texts, batch_size: int, repeats: int = 5) -> float:
+    """Latence mediane par lot, en millisecondes"""
+    enc = encode(tokenizer, texts[:batch_size])
+    timings = []
+    with torch.no_grad():
+        model(enc['input_ids'], enc['attention_mask'])  # warmup
+        for _ in range(repeats):
+            start = time.perf_counter()
+            model(enc['input_ids'], enc['attention_mask'])
+            timings.append((time.perf_counter() - start) * 1000)
+    return float(np.median(timings))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Distillation de RoBERTa vers un etudiant a 4-6 couches")
+    parser.add_argument('teacher', help="Checkpoint du professeur (roberta_toxic_best.pt)")
+    parser.add_argument('train', help="CSV d'entrainement avec une colonne comment_text")
+    parser.add_argument('--eval', help="CSV annote (comment_text + labels) pour l'AUC")
+    parser.add_argument('--tokenizer', default='roberta-base')
+    parser.add_argument('--layers', type=int, nargs='+', default=[6])
+    parser.add_argument('--limit', type=int, default=2000, help="Nombre de commentaires d'entrainement")
+    parser.add_argument('--eval-limit', type=int, default=1000)
+    parser.add_argument('--epochs', type=int, default=1)
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--lr', type=float, default=5e-5)
+    parser.add_argument('--temperature', type=float, default=2.0)
+    parser.add_argument('--alpha', type=float, default=0.0,
+                        help="Poids de la perte sur les vrais labels (si presents dans le CSV)")
+    parser.add_argument('--output-dir', default='.')
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    np.random.seed(0)
+
+    tokenizer = RobertaTokenizer.from_pretrained(args.tokenizer)
+    teacher_state = torch.load(args.teacher, map_location=device)
+    teacher = RobertaToxicClassifier(num_labels=len(LABEL_COLS), num_layers=count_encoder_layers(teacher_state))
+    teacher.load_state_dict(teacher_state)
+    teacher.to(device).eval()
+
+    train_df = pd.read_csv(args.train).dropna(subset=['comment_text']).head(args.limit)
+    texts = train_df['comment_text'].astype(str).tolist()
+    labels = None
+    if args.alpha > 0 and all(label in train_df for label in LABEL_COLS):
+        labels = torch.tensor(train_df[LABEL_COLS].to_numpy(), dtype=torch.float32)
+
+    print(f"Logits du professeur sur {len(texts)} commentaires...")
+    teacher_logits = predict_logits(teacher, tokenizer, texts, args.batch_size)
+
+    eval_df = None
+    if args.eval:
+        eval_df = pd.read_csv(args.eval).dropna(subset=['comment_text']).head(args.eval_limit)
+        eval_df['comment_text'] = eval_df['comment_text'].astype(str)
+
+    report = [('teacher', teacher.roberta.config.num_hidden_layers, teacher)]
+    for num_layers in args.layers:
+        print(f"Distillation vers {num_layers} couches...")
+        student = distill(build_student(teacher_state, num_layers), tokenizer, texts, teacher_logits, labels, args)
+        path = os.path.join(args.output_dir, f'roberta_toxic_student_{num_layers}l.pt')
+        torch.save(student.state_dict(), path)
+        print(f"  checkpoint: {path}")
+        report.append((f'student_{num_layers}l', num_layers, student))
+
+    print()
+    print("| Modele | Couches | Latence bs=1 (ms) | Latence bs=16 (ms) | AUC moyenne |")
+    print("|--------|---------|-------------------|--------------------|-------------|")
+    for name, num_layers, model in report:
+        auc = mean_auc(model, tokenizer, eval_df, args.batch_size) if eval_df is not None else float('nan')
+        print(f"| {name} | {num_layers} | {latency_ms(model, tokenizer, texts, 1):.1f} "
+              f"| {latency_ms(model, tokenizer, texts, 16):.1f} | {auc:.4f} |")
+
+
+if __name__ == '__main__':
+    main()
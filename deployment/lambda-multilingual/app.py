@@ -6,15 +6,20 @@ Supporte: Francais, Anglais, Arabe et 100+ autres langues
 
 import os
 # Configure Hugging Face cache - utilise le cache pre-telecharge dans l'image Docker
-os.environ['HF_HOME'] = '/var/task/hf_cache'
-os.environ['TRANSFORMERS_CACHE'] = '/var/task/hf_cache'
-os.environ['TORCH_HOME'] = '/tmp/torch_cache'
+# (surchargeable hors Lambda, par ex. HF_HOME=~/.cache/huggingface pour server.py)
+os.environ.setdefault('HF_HOME', '/var/task/hf_cache')
+os.environ.setdefault('TRANSFORMERS_CACHE', os.environ['HF_HOME'])
+os.environ.setdefault('TORCH_HOME', '/tmp/torch_cache')
 
 import json
+import resource
+import sys
+from collections import OrderedDict
 import torch
 import numpy as np
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Header, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel, Field
 from typing import List, Dict, Optional, Any
 from mangum import Mangum
@@ -23,6 +28,11 @@ from transformers import AutoModelForSequenceClassification, AutoTokenizer
 # Configuration
 MODEL_NAME = 'unitary/multilingual-toxic-xlm-roberta'
 LABELS = ['toxic']  # Ce modele fait une classification binaire
+THRESHOLD = 0.5
+COMPACT_MEDIA_TYPE = 'application/vnd.toxic.compact+json'
+CALIBRATION_PATH = os.environ.get('CALIBRATION_PATH', '/var/task/multilingual_calibration.npz')
+EXPLAIN_CACHE_SIZE = int(os.environ.get('EXPLAIN_CACHE_SIZE', 1024))
+MEMORY_BUDGET_MB = float(os.environ.get('MEMORY_BUDGET_MB', 1024))
 
 # Device
 device = torch.device('cpu')
@@ -65,6 +75,7 @@ class PredictionResponse(BaseModel):
 # Variables globales
 model = None
 tokenizer = None
+explain_cache = OrderedDict()
 
 # Pre-charger le modele au demarrage du module
 print("Pre-chargement du modele au demarrage...")
@@ -79,6 +90,33 @@ except Exception as e:
     model = None
     tokenizer = None
 
+def load_calibration():
+    """Charge la table de calibration (None si absente : seuil fixe)"""
+    if not os.path.exists(CALIBRATION_PATH):
+        print(f"Pas de table de calibration, seuil {THRESHOLD} utilise")
+        return None
+
+    table = np.load(CALIBRATION_PATH)
+    if list(table['labels']) != LABELS:
+        print(f"Table de calibration ignoree, labels inattendus: {list(table['labels'])}")
+        return None
+
+    return {
+        'knots': table['knots'][0].astype(np.float64),
+        'values': table['values'][0],
+        'threshold': float(table['thresholds'][0])
+    }
+
+def apply_calibration(probs: np.ndarray):
+    """Retourne (probabilites calibrees, seuil) pour un tableau de probabilites brutes"""
+    if calibration is None:
+        return probs, THRESHOLD
+
+    idx = np.searchsorted(calibration['knots'], probs, side='right') - 1
+    return calibration['values'][idx], calibration['threshold']
+
+calibration = load_calibration()
+
 def load_model():
     """Charge le modele depuis Hugging Face"""
     global model, tokenizer
@@ -205,6 +243,53 @@ def get_confidence_level(probability: float) -> str:
     else:
         return 'Tres faible'
 
+class RequestTooLarge(Exception):
+    """Requete dont l'inference depasserait le budget memoire"""
+
+def memory_usage_mb() -> Dict[str, float]:
+    """Pic de RSS du processus, et RSS courant si /proc est disponible (Linux)"""
+    # ru_maxrss est en Ko sous Linux, en octets sous macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    usage = {"peak_rss_mb": round(peak / (2**20 if sys.platform == 'darwin' else 1024), 1)}
+
+    if os.path.exists('/proc/self/statm'):
+        with open('/proc/self/statm') as f:
+            rss_pages = int(f.read().split()[1])
+        usage["rss_mb"] = round(rss_pages * resource.getpagesize() / 2**20, 1)
+
+    return usage
+
+def estimate_activation_bytes(batch_size: int, seq_len: int, layers: int = 1) -> int:
+    """Memoire d'activation estimee (float32) d'un lot pade a seq_len tokens.
+    Sans gradient, une seule couche est vivante a la fois ; avec backward, toutes (layers)."""
+    config = model.config
+    per_token = 4 * (8 * config.hidden_size + 2 * config.intermediate_size)
+    attention = 4 * 2 * config.num_attention_heads * seq_len * seq_len
+    return batch_size * layers * (seq_len * per_token + attention)
+
+def admit(batch_size: int, seq_len: int, layers: int = 1):
+    """Rejette une passe dont l'estimation depasse le budget memoire"""
+    needed = estimate_activation_bytes(batch_size, seq_len, layers)
+    if needed > MEMORY_BUDGET_MB * 2**20:
+        raise RequestTooLarge(
+            f"Requete trop volumineuse: ~{needed / 2**20:.0f} MB estimes pour un budget de {MEMORY_BUDGET_MB:.0f} MB"
+        )
+
+def plan_batches(lengths: List[int]) -> List[List[int]]:
+    """Decoupe un lot en sous-lots tenant chacun dans le budget memoire.
+    Les commentaires sont tries par longueur pour limiter le padding."""
+    chunks, current = [], []
+    for i in np.argsort(lengths, kind='stable').tolist():
+        # Tri croissant : lengths[i] est la longueur de padding du sous-lot
+        if current and estimate_activation_bytes(len(current) + 1, lengths[i]) > MEMORY_BUDGET_MB * 2**20:
+            chunks.append(current)
+            current = []
+        admit(len(current) + 1, lengths[i])
+        current.append(i)
+    if current:
+        chunks.append(current)
+    return chunks
+
 def predict_toxicity(text: str) -> Dict[str, Any]:
     """Predit la toxicite d'un texte"""
     global model, tokenizer
@@ -222,6 +307,7 @@ def predict_toxicity(text: str) -> Dict[str, Any]:
     )
 
     inputs = {k: v.to(device) for k, v in inputs.items()}
+    admit(1, inputs['input_ids'].shape[1])
 
     # Prediction
     with torch.no_grad():
@@ -237,7 +323,9 @@ def predict_toxicity(text: str) -> Dict[str, Any]:
             probs = torch.softmax(logits, dim=1)
             toxic_prob = probs[0][1].item()
 
-        is_toxic = toxic_prob >= 0.5
+    calibrated, threshold = apply_calibration(np.array([toxic_prob]))
+    toxic_prob = float(calibrated[0])
+    is_toxic = toxic_prob >= threshold
 
     # Detection de langue
     lang = detect_language(text)
@@ -250,6 +338,113 @@ def predict_toxicity(text: str) -> Dict[str, Any]:
         'model': 'XLM-RoBERTa Multilingual'
     }
 
+def logits_to_toxic_prob(logits: torch.Tensor) -> torch.Tensor:
+    """Convertit les logits (sigmoid ou softmax selon la tete) en probabilite toxique"""
+    if logits.shape[-1] == 1:
+        return torch.sigmoid(logits[:, 0])
+    return torch.softmax(logits, dim=1)[:, 1]
+
+def predict_proba_batch(texts: List[str]) -> np.ndarray:
+    """Predit la probabilite toxique d'un lot, en sous-lots bornes par le budget memoire"""
+    global model, tokenizer
+
+    if model is None or tokenizer is None:
+        load_model()
+
+    # Tokenisation sans padding : les longueurs servent a planifier les sous-lots
+    encoding = tokenizer(texts, truncation=True, max_length=512)
+    lengths = [len(ids) for ids in encoding['input_ids']]
+
+    probs = np.empty(len(texts), dtype=np.float32)
+    for chunk in plan_batches(lengths):
+        # Padding dynamique : chaque sous-lot est aligne sur son plus long commentaire
+        inputs = tokenizer.pad(
+            {k: [encoding[k][i] for i in chunk] for k in ('input_ids', 'attention_mask')},
+            return_tensors='pt'
+        )
+        inputs = {k: v.to(device) for k, v in inputs.items()}
+        with torch.no_grad():
+            logits = model(**inputs).logits
+            probs[chunk] = logits_to_toxic_prob(logits).cpu().numpy()
+
+    return probs
+
+def wants_compact(format: str, accept: Optional[str]) -> bool:
+    """Le format compact est choisi via ?format=compact ou l'en-tete Accept"""
+    return format == 'compact' or (accept is not None and COMPACT_MEDIA_TYPE in accept)
+
+def compact_batch_response(probs: np.ndarray, threshold: float, languages: List[str],
+                           calibrated: bool = True) -> ORJSONResponse:
+    """Reponse colonnaire : une ligne [p] par commentaire, meme schema que RoBERTa et XGBoost"""
+    is_toxic = probs >= threshold
+    toxic_count = int(is_toxic.sum())
+    return ORJSONResponse(
+        {
+            "total_comments": len(probs),
+            "toxic_count": toxic_count,
+            "clean_count": len(probs) - toxic_count,
+            "model": "XLM-RoBERTa Multilingual",
+            "calibrated": calibrated,
+            "labels": LABELS,
+            "thresholds": [round(threshold, 4)],
+            "probabilities": np.round(probs, 4)[:, None].tolist(),
+            "is_toxic": is_toxic.tolist(),
+            "language_detected": languages
+        },
+        media_type=COMPACT_MEDIA_TYPE
+    )
+
+def explain_toxicity(text: str) -> Dict[str, Any]:
+    """Attribution gradient x input par token, en une passe avant/arriere"""
+    global model, tokenizer
+
+    if text in explain_cache:
+        explain_cache.move_to_end(text)
+        return explain_cache[text]
+
+    if model is None or tokenizer is None:
+        load_model()
+
+    # Pas de padding : chaque position correspond a un vrai token
+    inputs = tokenizer(text, return_tensors='pt', truncation=True, max_length=512)
+    input_ids = inputs['input_ids'].to(device)
+    attention_mask = inputs['attention_mask'].to(device)
+    admit(1, input_ids.shape[1], layers=model.config.num_hidden_layers)
+
+    with torch.enable_grad():
+        embeddings = model.get_input_embeddings()(input_ids).detach()
+        embeddings.requires_grad_(True)
+        logits = model(inputs_embeds=embeddings, attention_mask=attention_mask).logits
+        # Cible : le logit de la classe toxique (avant sigmoid/softmax), comme pour RoBERTa
+        toxic_logit = logits[:, 0] if logits.shape[-1] == 1 else logits[:, 1]
+        grads, = torch.autograd.grad(toxic_logit.sum(), embeddings)
+
+    attributions = (grads * embeddings).sum(dim=-1)[0].detach().cpu().numpy()
+    calibrated, threshold = apply_calibration(logits_to_toxic_prob(logits).detach().cpu().numpy())
+    prob = float(calibrated[0])
+
+    # Retirer <s> et </s>
+    ids = input_ids[0].tolist()
+    keep = [i for i, token_id in enumerate(ids) if token_id not in tokenizer.all_special_ids]
+    # Le marqueur SentencePiece de debut de mot devient un espace, comme dans les tokens RoBERTa
+    tokens = [t.replace('\u2581', ' ') for t in tokenizer.convert_ids_to_tokens([ids[i] for i in keep])]
+
+    result = {
+        'is_toxic': prob >= threshold,
+        'toxic_probability': round(prob, 4),
+        'confidence': get_confidence_level(prob),
+        'language_detected': detect_language(text),
+        'tokens': tokens,
+        'attributions': np.round(attributions[keep], 4).tolist(),
+        'method': 'gradient_x_input',
+        'model': 'XLM-RoBERTa Multilingual'
+    }
+
+    explain_cache[text] = result
+    if len(explain_cache) > EXPLAIN_CACHE_SIZE:
+        explain_cache.popitem(last=False)
+    return result
+
 # Endpoints
 @app.get("/")
 async def root():
@@ -258,7 +453,7 @@ async def root():
         "version": "1.0.0",
         "model": "XLM-RoBERTa Multilingual (unitary/multilingual-toxic-xlm-roberta)",
         "languages": ["en", "fr", "ar", "+100 autres"],
-        "endpoints": ["/predict", "/predict/batch", "/health"]
+        "endpoints": ["/predict", "/predict/batch", "/explain", "/health"]
     }
 
 @app.get("/health")
@@ -269,7 +464,9 @@ async def health():
         "model_loaded": model is not None,
         "tokenizer_loaded": tokenizer is not None,
         "model_type": "XLM-RoBERTa Multilingual",
-        "supported_languages": ["en", "fr", "ar", "es", "de", "it", "pt", "ru", "zh", "ja", "+90 autres"]
+        "supported_languages": ["en", "fr", "ar", "es", "de", "it", "pt", "ru", "zh", "ja", "+90 autres"],
+        "memory_budget_mb": MEMORY_BUDGET_MB,
+        **memory_usage_mb()
     }
 
 @app.post("/predict", response_model=PredictionResponse)
@@ -279,13 +476,33 @@ async def predict(request: CommentRequest):
         result = predict_toxicity(request.text)
         return PredictionResponse(**result)
 
+    except RequestTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/predict/batch")
-async def predict_batch(request: BatchRequest):
-    """Predit la toxicite de plusieurs commentaires"""
+async def predict_batch(
+    request: BatchRequest,
+    format: str = Query('verbose', pattern='^(verbose|compact)$'),
+    calibrated: bool = Query(True),
+    accept: Optional[str] = Header(None)
+):
+    """Predit la toxicite de plusieurs commentaires
+    calibrated=false (format compact) renvoie les probabilites brutes, entree de calibrate.py"""
+    compact = wants_compact(format, accept)
+    if not calibrated and not compact:
+        raise HTTPException(status_code=400, detail="calibrated=false n'est disponible qu'au format compact")
+
     try:
+        if compact:
+            probs = predict_proba_batch(request.comments)
+            if calibrated:
+                probs, threshold = apply_calibration(probs)
+            else:
+                threshold = THRESHOLD
+            return compact_batch_response(probs, threshold, [detect_language(c) for c in request.comments], calibrated)
+
         results = []
         toxic_count = 0
 
@@ -307,6 +524,19 @@ async def predict_batch(request: BatchRequest):
             "results": results
         }
 
+    except RequestTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/explain")
+async def explain(request: CommentRequest):
+    """Contribution de chaque token a la probabilite toxique"""
+    try:
+        return explain_toxicity(request.text)
+
+    except RequestTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -10,12 +10,17 @@ os.environ['TRANSFORMERS_CACHE'] = '/tmp/hf_cache'
 os.environ['TORCH_HOME'] = '/tmp/torch_cache'
 
 import json
+import re
+import resource
+import sys
+from collections import OrderedDict
 import boto3
 import torch
 import torch.nn as nn
 import numpy as np
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Header, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel, Field
 from typing import List, Dict, Optional, Any
 from mangum import Mangum
@@ -25,7 +30,12 @@ from transformers import RobertaModel, RobertaTokenizer
 S3_BUCKET = os.environ.get('S3_BUCKET', 'toxic-classifier-models-bucket')
 MODEL_KEY = os.environ.get('MODEL_KEY', 'models/roberta_toxic_best.pt')
 TOKENIZER_PREFIX = os.environ.get('TOKENIZER_PREFIX', 'models/roberta_tokenizer/')
+CALIBRATION_KEY = os.environ.get('CALIBRATION_KEY', 'models/roberta_calibration.npz')
 LABEL_COLS = ['toxic', 'severe_toxic', 'obscene', 'threat', 'insult', 'identity_hate']
+THRESHOLD = 0.5
+COMPACT_MEDIA_TYPE = 'application/vnd.toxic.compact+json'
+EXPLAIN_CACHE_SIZE = int(os.environ.get('EXPLAIN_CACHE_SIZE', 1024))
+MEMORY_BUDGET_MB = float(os.environ.get('MEMORY_BUDGET_MB', 512))
 
 # Device
 device = torch.device('cpu')  # Lambda utilise CPU
@@ -69,14 +79,15 @@ class PredictionResponse(BaseModel):
 
 # Architecture du modèle RoBERTa
 class RobertaToxicClassifier(nn.Module):
-    def __init__(self, num_labels=6, dropout=0.3):
+    def __init__(self, num_labels=6, dropout=0.3, num_layers=12):
         super().__init__()
-        self.roberta = RobertaModel.from_pretrained('roberta-base')
+        # num_layers < 12 : modèle étudiant distillé (voir deployment/distillation)
+        self.roberta = RobertaModel.from_pretrained('roberta-base', num_hidden_layers=num_layers)
         self.dropout = nn.Dropout(dropout)
         self.classifier = nn.Linear(self.roberta.config.hidden_size, num_labels)
 
-    def forward(self, input_ids, attention_mask):
-        outputs = self.roberta(input_ids=input_ids, attention_mask=attention_mask)
+    def forward(self, input_ids=None, attention_mask=None, inputs_embeds=None):
+        outputs = self.roberta(input_ids=input_ids, attention_mask=attention_mask, inputs_embeds=inputs_embeds)
         pooled_output = outputs.last_hidden_state[:, 0, :]
         pooled_output = self.dropout(pooled_output)
         return self.classifier(pooled_output)
@@ -84,6 +95,8 @@ class RobertaToxicClassifier(nn.Module):
 # Variables globales
 model = None
 tokenizer = None
+calibration = None
+explain_cache = OrderedDict()
 
 def download_from_s3(bucket, key, local_path):
     """Télécharge un fichier depuis S3"""
@@ -111,9 +124,45 @@ def download_tokenizer_from_s3():
 
     return local_dir
 
+def load_calibration():
+    """Charge la table de calibration depuis S3 (None si absente : seuil fixe)"""
+    local_path = '/tmp/roberta_calibration.npz'
+    try:
+        download_from_s3(S3_BUCKET, CALIBRATION_KEY, local_path)
+        table = np.load(local_path)
+    except Exception as e:
+        print(f"Pas de table de calibration, seuil {THRESHOLD} utilisé: {e}")
+        return None
+
+    if list(table['labels']) != LABEL_COLS:
+        print(f"Table de calibration ignorée, labels inattendus: {list(table['labels'])}")
+        return None
+
+    # Décalage de 2 par label : toutes les lignes de knots tiennent dans un seul tableau trié
+    offsets = 2.0 * np.arange(len(LABEL_COLS))
+    return {
+        'knots': (table['knots'].astype(np.float64) + offsets[:, None]).ravel(),
+        'values': table['values'].ravel(),
+        'offsets': offsets,
+        'thresholds': table['thresholds']
+    }
+
+def apply_calibration(probs: np.ndarray):
+    """Retourne (probabilités calibrées, seuils par label) pour un tableau (n, 6)"""
+    if calibration is None:
+        return probs, np.full(len(LABEL_COLS), THRESHOLD)
+
+    idx = np.searchsorted(calibration['knots'], probs + calibration['offsets'], side='right') - 1
+    return calibration['values'][idx], calibration['thresholds']
+
+def count_encoder_layers(state_dict) -> int:
+    """Nombre de couches Transformer d'un checkpoint (12 pour le modèle complet)"""
+    layers = {int(m.group(1)) for k in state_dict if (m := re.match(r'roberta\.encoder\.layer\.(\d+)\.', k))}
+    return len(layers)
+
 def load_model_from_s3():
     """Charge le modèle et le tokenizer depuis S3"""
-    global model, tokenizer
+    global model, tokenizer, calibration
 
     if model is not None and tokenizer is not None:
         return model, tokenizer
@@ -131,11 +180,15 @@ def load_model_from_s3():
         download_from_s3(S3_BUCKET, MODEL_KEY, model_path)
 
         # Charger le modèle
-        model = RobertaToxicClassifier(num_labels=6)
-        model.load_state_dict(torch.load(model_path, map_location=device))
+        state_dict = torch.load(model_path, map_location=device)
+        num_layers = count_encoder_layers(state_dict)
+        model = RobertaToxicClassifier(num_labels=6, num_layers=num_layers)
+        model.load_state_dict(state_dict)
         model.to(device)
         model.eval()
-        print("Modèle RoBERTa chargé!")
+        print(f"Modèle RoBERTa chargé! ({num_layers} couches)")
+
+        calibration = load_calibration()
 
         return model, tokenizer
 
@@ -143,6 +196,53 @@ def load_model_from_s3():
         print(f"Erreur chargement modèle: {e}")
         raise e
 
+class RequestTooLarge(Exception):
+    """Requête dont l'inférence dépasserait le budget mémoire"""
+
+def memory_usage_mb() -> Dict[str, float]:
+    """Pic de RSS du processus, et RSS courant si /proc est disponible (Linux)"""
+    # ru_maxrss est en Ko sous Linux, en octets sous macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    usage = {"peak_rss_mb": round(peak / (2**20 if sys.platform == 'darwin' else 1024), 1)}
+
+    if os.path.exists('/proc/self/statm'):
+        with open('/proc/self/statm') as f:
+            rss_pages = int(f.read().split()[1])
+        usage["rss_mb"] = round(rss_pages * resource.getpagesize() / 2**20, 1)
+
+    return usage
+
+def estimate_activation_bytes(batch_size: int, seq_len: int, layers: int = 1) -> int:
+    """Mémoire d'activation estimée (float32) d'un lot padé à seq_len tokens.
+    Sans gradient, une seule couche est vivante à la fois ; avec backward, toutes (layers)."""
+    config = model.roberta.config
+    per_token = 4 * (8 * config.hidden_size + 2 * config.intermediate_size)
+    attention = 4 * 2 * config.num_attention_heads * seq_len * seq_len
+    return batch_size * layers * (seq_len * per_token + attention)
+
+def admit(batch_size: int, seq_len: int, layers: int = 1):
+    """Rejette une passe dont l'estimation dépasse le budget mémoire"""
+    needed = estimate_activation_bytes(batch_size, seq_len, layers)
+    if needed > MEMORY_BUDGET_MB * 2**20:
+        raise RequestTooLarge(
+            f"Requête trop volumineuse: ~{needed / 2**20:.0f} MB estimés pour un budget de {MEMORY_BUDGET_MB:.0f} MB"
+        )
+
+def plan_batches(lengths: List[int]) -> List[List[int]]:
+    """Découpe un lot en sous-lots tenant chacun dans le budget mémoire.
+    Les commentaires sont triés par longueur pour limiter le padding."""
+    chunks, current = [], []
+    for i in np.argsort(lengths, kind='stable').tolist():
+        # Tri croissant : lengths[i] est la longueur de padding du sous-lot
+        if current and estimate_activation_bytes(len(current) + 1, lengths[i]) > MEMORY_BUDGET_MB * 2**20:
+            chunks.append(current)
+            current = []
+        admit(len(current) + 1, lengths[i])
+        current.append(i)
+    if current:
+        chunks.append(current)
+    return chunks
+
 def predict_toxicity(text: str) -> Dict[str, Dict]:
     """Prédit la toxicité avec RoBERTa"""
     global model, tokenizer
@@ -161,25 +261,141 @@ def predict_toxicity(text: str) -> Dict[str, Dict]:
 
     input_ids = encoding['input_ids'].to(device)
     attention_mask = encoding['attention_mask'].to(device)
+    admit(1, input_ids.shape[1])
 
     # Prédiction
     with torch.no_grad():
         outputs = model(input_ids, attention_mask)
-        probs = torch.sigmoid(outputs).cpu().numpy()[0]
+        probs = torch.sigmoid(outputs).cpu().numpy()
+
+    probs, thresholds = apply_calibration(probs)
 
     # Formater les résultats
     results = {}
-    threshold = 0.5
 
     for i, label in enumerate(LABEL_COLS):
-        prob = float(probs[i])
+        prob = float(probs[0][i])
         results[label] = {
             'probability': round(prob, 4),
-            'detected': prob >= threshold
+            'detected': prob >= float(thresholds[i])
         }
 
     return results
 
+def predict_proba_batch(texts: List[str]) -> np.ndarray:
+    """Prédit les probabilités d'un lot en sous-lots bornés par le budget mémoire (colonnes dans l'ordre LABEL_COLS)"""
+    global model, tokenizer
+
+    if model is None or tokenizer is None:
+        load_model_from_s3()
+
+    # Tokenisation sans padding : les longueurs servent à planifier les sous-lots
+    encoding = tokenizer(texts, truncation=True, max_length=128)
+    lengths = [len(ids) for ids in encoding['input_ids']]
+
+    probs = np.empty((len(texts), len(LABEL_COLS)), dtype=np.float32)
+    for chunk in plan_batches(lengths):
+        # Padding dynamique : chaque sous-lot est aligné sur son plus long commentaire
+        batch = tokenizer.pad(
+            {k: [encoding[k][i] for i in chunk] for k in ('input_ids', 'attention_mask')},
+            return_tensors='pt'
+        )
+        with torch.no_grad():
+            outputs = model(batch['input_ids'].to(device), batch['attention_mask'].to(device))
+            probs[chunk] = torch.sigmoid(outputs).cpu().numpy()
+
+    return probs
+
+def wants_compact(format: str, accept: Optional[str]) -> bool:
+    """Le format compact est choisi via ?format=compact ou l'en-tête Accept"""
+    return format == 'compact' or (accept is not None and COMPACT_MEDIA_TYPE in accept)
+
+def compact_batch_response(probs: np.ndarray, thresholds: np.ndarray, calibrated: bool = True) -> ORJSONResponse:
+    """Réponse colonnaire : une ligne de probabilités par commentaire, seuils envoyés une seule fois"""
+    is_toxic = (probs >= thresholds).any(axis=1)
+    toxic_count = int(is_toxic.sum())
+    return ORJSONResponse(
+        {
+            "total_comments": len(probs),
+            "toxic_count": toxic_count,
+            "clean_count": len(probs) - toxic_count,
+            "model": "RoBERTa",
+            "calibrated": calibrated,
+            "labels": LABEL_COLS,
+            "thresholds": np.round(thresholds, 4).tolist(),
+            "probabilities": np.round(probs, 4).tolist(),
+            "is_toxic": is_toxic.tolist()
+        },
+        media_type=COMPACT_MEDIA_TYPE
+    )
+
+def explain_toxicity(text: str) -> Dict[str, Any]:
+    """Attribution gradient x input par token, pour les six labels (une passe avant/arrière si le budget le permet)"""
+    global model, tokenizer
+
+    if text in explain_cache:
+        explain_cache.move_to_end(text)
+        return explain_cache[text]
+
+    if model is None or tokenizer is None:
+        load_model_from_s3()
+
+    # Pas de padding : chaque position correspond à un vrai token
+    encoding = tokenizer(text, truncation=True, max_length=128, return_tensors='pt')
+    input_ids = encoding['input_ids'].to(device)
+    attention_mask = encoding['attention_mask'].to(device)
+
+    # Le backward garde les activations de toutes les couches : seule une copie
+    # qui ne tient pas seule dans le budget est rejetée
+    n = len(LABEL_COLS)
+    seq_len = input_ids.shape[1]
+    layers = model.roberta.config.num_hidden_layers
+    admit(1, seq_len, layers=layers)
+    group_size = min(n, int(MEMORY_BUDGET_MB * 2**20 // estimate_activation_bytes(1, seq_len, layers)))
+
+    # Une copie des embeddings par label : la cible de la ligne i est le logit brut de son label.
+    # Les copies sont traitées par groupes tenant dans le budget (une seule passe si possible).
+    embeddings = model.roberta.embeddings.word_embeddings(input_ids).detach()
+    attributions = np.empty((n, seq_len), dtype=np.float32)
+    with torch.enable_grad():
+        for start in range(0, n, group_size):
+            group = list(range(start, min(start + group_size, n)))
+            copies = embeddings.repeat(len(group), 1, 1).requires_grad_(True)
+            logits = model(attention_mask=attention_mask.repeat(len(group), 1), inputs_embeds=copies)
+            target = logits[torch.arange(len(group)), group].sum()
+            grads, = torch.autograd.grad(target, copies)
+            attributions[group] = (grads * copies).sum(dim=-1).detach().cpu().numpy()
+
+    probs, thresholds = apply_calibration(torch.sigmoid(logits[:1]).detach().cpu().numpy())
+
+    # Retirer <s> et </s>
+    ids = input_ids[0].tolist()
+    keep = [i for i, token_id in enumerate(ids) if token_id not in tokenizer.all_special_ids]
+    # convert_tokens_to_string garde l'espace de début de mot (marqueur Ġ)
+    tokens = [tokenizer.convert_tokens_to_string([t]) for t in tokenizer.convert_ids_to_tokens([ids[i] for i in keep])]
+
+    labels = {}
+    for i, label in enumerate(LABEL_COLS):
+        prob = float(probs[0][i])
+        labels[label] = {
+            'probability': round(prob, 4),
+            'detected': prob >= float(thresholds[i]),
+            'attributions': np.round(attributions[i, keep], 4).tolist()
+        }
+
+    result = {
+        'is_toxic': any(info['detected'] for info in labels.values()),
+        'tokens': tokens,
+        'labels': labels,
+        'method': 'gradient_x_input',
+        'model': 'RoBERTa'
+    }
+
+    explain_cache[text] = result
+    if len(explain_cache) > EXPLAIN_CACHE_SIZE:
+        explain_cache.popitem(last=False)
+    return result
+
 # Endpoints
 @app.get("/")
 async def root():
@@ -187,7 +403,7 @@ async def root():
         "message": "Toxic Comment Classifier API - RoBERTa",
         "version": "1.0.0",
         "model": "RoBERTa (Deep Learning)",
-        "endpoints": ["/predict", "/predict/batch", "/health"]
+        "endpoints": ["/predict", "/predict/batch", "/explain", "/health"]
     }
 
 @app.get("/health")
@@ -198,7 +414,9 @@ async def health():
         "model_loaded": model is not None,
         "tokenizer_loaded": tokenizer is not None,
         "model_type": "RoBERTa",
-        "device": str(device)
+        "device": str(device),
+        "memory_budget_mb": MEMORY_BUDGET_MB,
+        **memory_usage_mb()
     }
 
 @app.post("/predict", response_model=PredictionResponse)
@@ -227,13 +445,33 @@ async def predict(request: CommentRequest):
             }
         )
 
+    except RequestTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/predict/batch")
-async def predict_batch(request: BatchRequest):
-    """Prédit la toxicité de plusieurs commentaires avec RoBERTa"""
+async def predict_batch(
+    request: BatchRequest,
+    format: str = Query('verbose', pattern='^(verbose|compact)$'),
+    calibrated: bool = Query(True),
+    accept: Optional[str] = Header(None)
+):
+    """Prédit la toxicité de plusieurs commentaires avec RoBERTa
+    calibrated=false (format compact) renvoie les probabilités brutes, entrée de calibrate.py"""
+    compact = wants_compact(format, accept)
+    if not calibrated and not compact:
+        raise HTTPException(status_code=400, detail="calibrated=false n'est disponible qu'au format compact")
+
     try:
+        if compact:
+            probs = predict_proba_batch(request.comments)
+            if calibrated:
+                probs, thresholds = apply_calibration(probs)
+            else:
+                thresholds = np.full(len(LABEL_COLS), THRESHOLD)
+            return compact_batch_response(probs, thresholds, calibrated)
+
         results = []
         toxic_count = 0
 
@@ -260,6 +498,19 @@ async def predict_batch(request: BatchRequest):
             "results": results
         }
 
+    except RequestTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/explain")
+async def explain(request: CommentRequest):
+    """Contribution de chaque token à la prédiction de chaque label"""
+    try:
+        return explain_toxicity(request.text)
+
+    except RequestTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
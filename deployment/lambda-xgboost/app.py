@@ -7,11 +7,14 @@ import json
 import os
 import pickle
 import re
+import resource
+import sys
 import boto3
 import numpy as np
 import pandas as pd
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Header, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel, Field
 from typing import List, Dict, Optional, Any
 from mangum import Mangum
@@ -31,7 +34,9 @@ except:
 # Configuration
 S3_BUCKET = os.environ.get('S3_BUCKET', 'toxic-classifier-models-bucket')
 MODEL_KEY = os.environ.get('MODEL_KEY', 'models/toxic_classifier.pkl')
+CALIBRATION_KEY = os.environ.get('CALIBRATION_KEY', 'models/xgboost_calibration.npz')
 LABEL_COLS = ['toxic', 'severe_toxic', 'obscene', 'threat', 'insult', 'identity_hate']
+COMPACT_MEDIA_TYPE = 'application/vnd.toxic.compact+json'
 
 # Application FastAPI
 app = FastAPI(
@@ -96,6 +101,35 @@ def load_model_from_s3():
         print(f"Erreur chargement modèle: {e}")
         raise e
 
+def load_calibration():
+    """Charge la table de calibration depuis S3 (None si absente : seuils du pickle)"""
+    s3 = boto3.client('s3')
+    local_path = '/tmp/xgboost_calibration.npz'
+
+    try:
+        s3.download_file(S3_BUCKET, CALIBRATION_KEY, local_path)
+        table = np.load(local_path)
+    except Exception as e:
+        print(f"Pas de table de calibration, seuils du modèle utilisés: {e}")
+        return None
+
+    if list(table['labels']) != LABEL_COLS:
+        print(f"Table de calibration ignorée, labels inattendus: {list(table['labels'])}")
+        return None
+
+    return build_lookup(table)
+
+def build_lookup(table):
+    """Prépare une table .npz pour l'application en un seul np.searchsorted"""
+    # Décalage de 2 par label : toutes les lignes de knots tiennent dans un seul tableau trié
+    offsets = 2.0 * np.arange(len(table['labels']))
+    return {
+        'knots': (table['knots'].astype(np.float64) + offsets[:, None]).ravel(),
+        'values': table['values'].ravel(),
+        'offsets': offsets,
+        'thresholds': table['thresholds']
+    }
+
 class ToxicClassifierWrapper:
     """Wrapper pour le classificateur avec preprocessing intégré"""
 
@@ -103,7 +137,12 @@ class ToxicClassifierWrapper:
         self.vectorizer = model_data['tfidf']
         self.models = model_data['models']
         self.thresholds = model_data['thresholds']
+        # Seuils du pickle, associés aux probabilités brutes (?calibrated=false)
+        self.raw_thresholds = model_data['thresholds']
         self.stop_words = model_data.get('stop_words', set(stopwords.words('english')))
+        self.calibration = load_calibration()
+        if self.calibration is not None:
+            self.thresholds = {label: float(t) for label, t in zip(LABEL_COLS, self.calibration['thresholds'])}
 
     def preprocess(self, text):
         """Prétraitement du texte"""
@@ -120,23 +159,73 @@ class ToxicClassifierWrapper:
         except:
             return text
 
+    def calibrate(self, probs):
+        """Applique la table de calibration à un tableau (n, 6) de probabilités brutes"""
+        if self.calibration is None:
+            return probs
+
+        idx = np.searchsorted(self.calibration['knots'], probs + self.calibration['offsets'], side='right') - 1
+        return self.calibration['values'][idx]
+
     def predict(self, text):
         """Prédit la toxicité d'un commentaire"""
-        text_clean = self.preprocess(text)
-        X = self.vectorizer.transform([text_clean])
+        probs = self.predict_proba_batch([text])[0]
 
         results = {}
-        for label in LABEL_COLS:
-            proba = self.models[label].predict_proba(X)[0][1]
+        for i, label in enumerate(LABEL_COLS):
+            proba = float(probs[i])
             threshold = self.thresholds[label]
             results[label] = {
-                'probability': float(proba),
+                'probability': proba,
                 'threshold': threshold,
                 'detected': proba >= threshold
             }
 
         return results
 
+    def predict_proba_batch(self, texts, calibrated=True):
+        """Prédit les probabilités d'un lot de commentaires (colonnes dans l'ordre LABEL_COLS)"""
+        X = self.vectorizer.transform([self.preprocess(t) for t in texts])
+        probs = np.column_stack([self.models[label].predict_proba(X)[:, 1] for label in LABEL_COLS])
+        return self.calibrate(probs) if calibrated else probs
+
+def wants_compact(format: str, accept: Optional[str]) -> bool:
+    """Le format compact est choisi via ?format=compact ou l'en-tête Accept"""
+    return format == 'compact' or (accept is not None and COMPACT_MEDIA_TYPE in accept)
+
+def compact_batch_response(probs: np.ndarray, thresholds: np.ndarray, calibrated: bool = True) -> ORJSONResponse:
+    """Réponse colonnaire : une ligne de probabilités par commentaire, seuils envoyés une seule fois"""
+    detected = probs >= thresholds
+    is_toxic = detected.any(axis=1)
+    toxic_count = int(is_toxic.sum())
+    return ORJSONResponse(
+        {
+            "total_comments": len(probs),
+            "toxic_count": toxic_count,
+            "clean_count": len(probs) - toxic_count,
+            "model": "XGBoost",
+            "calibrated": calibrated,
+            "labels": LABEL_COLS,
+            "thresholds": np.round(thresholds, 4).tolist(),
+            "probabilities": np.round(probs, 4).tolist(),
+            "is_toxic": is_toxic.tolist()
+        },
+        media_type=COMPACT_MEDIA_TYPE
+    )
+
+def memory_usage_mb() -> Dict[str, float]:
+    """Pic de RSS du processus, et RSS courant si /proc est disponible (Linux)"""
+    # ru_maxrss est en Ko sous Linux, en octets sous macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    usage = {"peak_rss_mb": round(peak / (2**20 if sys.platform == 'darwin' else 1024), 1)}
+
+    if os.path.exists('/proc/self/statm'):
+        with open('/proc/self/statm') as f:
+            rss_pages = int(f.read().split()[1])
+        usage["rss_mb"] = round(rss_pages * resource.getpagesize() / 2**20, 1)
+
+    return usage
+
 # Endpoints
 @app.get("/")
 async def root():
@@ -153,7 +242,8 @@ async def health():
     return {
         "status": "healthy",
         "model_loaded": classifier is not None,
-        "model_type": "XGBoost"
+        "model_type": "XGBoost",
+        **memory_usage_mb()
     }
 
 @app.post("/predict", response_model=PredictionResponse)
@@ -191,15 +281,31 @@ async def predict(request: CommentRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/predict/batch")
-async def predict_batch(request: BatchRequest):
-    """Prédit la toxicité de plusieurs commentaires"""
+async def predict_batch(
+    request: BatchRequest,
+    format: str = Query('verbose', pattern='^(verbose|compact)$'),
+    calibrated: bool = Query(True),
+    accept: Optional[str] = Header(None)
+):
+    """Prédit la toxicité de plusieurs commentaires
+    calibrated=false (format compact) renvoie les probabilités brutes, entrée de calibrate.py"""
     global classifier
 
+    compact = wants_compact(format, accept)
+    if not calibrated and not compact:
+        raise HTTPException(status_code=400, detail="calibrated=false n'est disponible qu'au format compact")
+
     try:
         if classifier is None:
             model_data = load_model_from_s3()
             classifier = ToxicClassifierWrapper(model_data)
 
+        if compact:
+            probs = classifier.predict_proba_batch(request.comments, calibrated=calibrated)
+            source = classifier.thresholds if calibrated else classifier.raw_thresholds
+            thresholds = np.array([source[label] for label in LABEL_COLS], dtype=float)
+            return compact_batch_response(probs, thresholds, calibrated)
+
         results = []
         toxic_count = 0
 
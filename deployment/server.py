@@ -0,0 +1,127 @@
+"""
+Serveur ASGI multi-workers - deploiement on-premise
+Charge le modele une seule fois dans le processus parent, puis fork les workers
+qui partagent les poids en copy-on-write (gunicorn + preload_app).
+Les routes sont celles des handlers Lambda, montees sous /xgboost, /roberta ou /multilingual.
+
+Le service multilingual utilise par defaut le cache Hugging Face de l'image Lambda
+(/var/task/hf_cache) : hors Lambda, definir HF_HOME vers un repertoire accessible en ecriture.
+
+Usage:
+    python server.py roberta --workers-per-core 0.5 --threads 2
+    python server.py multilingual --workers 4 --bind 0.0.0.0:8080
+"""
+
+import argparse
+import gc
+import importlib
+import multiprocessing
+import os
+import sys
+
+from fastapi import FastAPI
+from gunicorn.app.base import BaseApplication
+
+DEPLOYMENT_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVICES = {
+    'xgboost': 'lambda-xgboost',
+    'roberta': 'lambda-roberta',
+    'multilingual': 'lambda-multilingual',
+}
+
+
+def import_service(service: str):
+    """Importe le module app.py d'un service Lambda"""
+    sys.path.insert(0, os.path.join(DEPLOYMENT_DIR, SERVICES[service]))
+    return importlib.import_module('app')
+
+
+def preload_model(service: str, module) -> None:
+    """Charge le modele dans le processus parent, avant le fork des workers"""
+    if service == 'xgboost':
+        module.classifier = module.ToxicClassifierWrapper(module.load_model_from_s3())
+    elif service == 'roberta':
+        module.load_model_from_s3()
+    else:
+        module.load_model()
+
+
+def build_app(module, prefix: str) -> FastAPI:
+    """Monte l'application du service sous le meme prefixe que l'API Gateway"""
+    if not prefix:
+        return module.app
+    root = FastAPI(title=module.app.title, version=module.app.version)
+    root.mount(prefix, module.app)
+    return root
+
+
+def default_workers(workers_per_core: float) -> int:
+    return max(1, int(multiprocessing.cpu_count() * workers_per_core))
+
+
+def default_threads(workers: int) -> int:
+    return max(1, multiprocessing.cpu_count() // workers)
+
+
+class PreloadedApplication(BaseApplication):
+    """Application gunicorn servant un objet ASGI deja charge en memoire"""
+
+    def __init__(self, application, options):
+        self.application = application
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.application
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serveur multi-workers pour les modeles de toxicite")
+    parser.add_argument('service', choices=sorted(SERVICES))
+    parser.add_argument('--bind', default=os.environ.get('BIND', '0.0.0.0:8000'))
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('WEB_CONCURRENCY', 0)),
+                        help="Nombre de workers (prioritaire sur --workers-per-core)")
+    parser.add_argument('--workers-per-core', type=float,
+                        default=float(os.environ.get('WORKERS_PER_CORE', 1)))
+    parser.add_argument('--threads', type=int, default=int(os.environ.get('TORCH_THREADS', 0)),
+                        help="Threads PyTorch par worker (defaut: coeurs / workers)")
+    parser.add_argument('--prefix', default=None,
+                        help="Prefixe des routes (defaut: /<service>, '' pour aucun)")
+    parser.add_argument('--timeout', type=int, default=int(os.environ.get('TIMEOUT', 120)))
+    args = parser.parse_args()
+
+    workers = args.workers or default_workers(args.workers_per_core)
+    threads = args.threads or default_threads(workers)
+    prefix = f"/{args.service}" if args.prefix is None else args.prefix.rstrip('/')
+
+    module = import_service(args.service)
+    preload_model(args.service, module)
+    application = build_app(module, prefix)
+
+    # Les objets charges jusqu'ici ne seront plus parcourus par le GC :
+    # leurs pages restent partagees entre les workers apres le fork
+    gc.collect()
+    gc.freeze()
+
+    def post_fork(server, worker):
+        if args.service != 'xgboost':
+            import torch
+            torch.set_num_threads(threads)
+
+    print(f"Service {args.service}: {workers} workers x {threads} threads sur {args.bind}{prefix}")
+    PreloadedApplication(application, {
+        'bind': args.bind,
+        'workers': workers,
+        'worker_class': 'uvicorn.workers.UvicornWorker',
+        'preload_app': True,
+        'timeout': args.timeout,
+        'post_fork': post_fork,
+    }).run()
+
+
+if __name__ == '__main__':
+    main()